@@ -2,19 +2,96 @@
 CF Zero Trust Third Layer - Configuration Parser
 """
 import os
+import re
+import sys
+import glob
 import json
-from typing import List, Dict, Optional
+import difflib
+import hashlib
+import argparse
+import functools
+from typing import List, Dict, Optional, Tuple
+
+SERVICE_TEMPLATE = '/app/service-template.conf'
+SERVICE_NOAUTH_TEMPLATE = '/app/service-noauth-template.conf'
+FALLBACK_TEMPLATE = '/app/offline_fallback.conf'
+
+NGINX_SITES_DIR = '/etc/nginx/sites-enabled'
+ONLINE_CONFIGS = '/tmp/online_configs'
+OFFLINE_CONFIGS = '/tmp/offline_configs'
+AUTH_CONFIG_FILE = '/tmp/auth_config.json'
+TARGETS_FILE = '/tmp/service_targets.json'
+MANIFEST_FILE = '/tmp/cftl_manifest.json'
+
+PLACEHOLDER_RE = re.compile(r'\{([A-Z_]+)\}')
+
+DEFAULT_SITE = """
+server {
+    listen %d;
+    server_name _;
+    
+    location / {
+        return 200 'CF Zero Trust Third Layer\\nStatus: Not Configured\\n\\nSet CONFIGS environment variable to enable third layer protection\\n';
+        add_header Content-Type text/plain;
+    }
+    
+    location /health {
+        return 200 'OK';
+        add_header Content-Type text/plain;
+    }
+}
+"""
+
+DEFAULT_PROFILE = 'websocket'
+
+# Proxy performance profiles selectable per service (6th CONFIGS field)
+PROXY_PROFILES = {
+    # Long-lived WebSocket / long-polling apps (Jupyter, IDEs, ...)
+    'websocket': {
+        'buffering': False,
+        'gzip': False,
+        'gzip_types': [],
+        'keepalive_timeout': '65s',
+        'connect_timeout': '60s',
+        'read_timeout': '86400s',
+        'send_timeout': '86400s',
+    },
+    # Plain HTTP APIs: buffer responses, compress JSON, fail fast
+    'api': {
+        'buffering': True,
+        'gzip': True,
+        'gzip_types': ['application/json', 'application/problem+json', 'text/plain'],
+        'keepalive_timeout': '15s',
+        'connect_timeout': '5s',
+        'read_timeout': '60s',
+        'send_timeout': '60s',
+    },
+    # Dashboards and static assets: buffer and compress text resources
+    'static': {
+        'buffering': True,
+        'gzip': True,
+        'gzip_types': ['text/plain', 'text/css', 'text/xml', 'text/javascript',
+                       'application/javascript', 'application/json', 'application/xml',
+                       'image/svg+xml'],
+        'keepalive_timeout': '65s',
+        'connect_timeout': '5s',
+        'read_timeout': '30s',
+        'send_timeout': '30s',
+    },
+}
 
 class ServiceConfig:
     """Service configuration for third layer protection"""
     
     def __init__(self, hostname: str, service: str, port: str, 
-                 aud: Optional[str] = None, emails: Optional[List[str]] = None):
+                 aud: Optional[str] = None, emails: Optional[List[str]] = None,
+                 profile: str = DEFAULT_PROFILE):
         self.hostname = hostname or '*'
         self.service = service
         self.port = port
         self.aud = aud
         self.emails = emails or []
+        self.profile = profile
         self.name = hostname.replace('.', '_').replace('*', 'default')
     
     def needs_auth(self) -> bool:
@@ -29,6 +106,7 @@ class ServiceConfig:
             'port': self.port,
             'aud': self.aud,
             'emails': self.emails,
+            'profile': self.profile,
             'name': self.name
         }
 
@@ -80,6 +158,7 @@ def parse_services_env() -> List[ServiceConfig]:
                 if item.strip():
                     configs.append(item.strip())
     
+    seen_names = set()
     for config_str in configs:
         if not config_str:
             continue
@@ -87,7 +166,7 @@ def parse_services_env() -> List[ServiceConfig]:
         parts = config_str.split(':')
         
         if len(parts) < 3:
-            print(f"[CFTL] ERROR: Invalid config (need hostname_alias:service_alias:port[:aud_alias[:email_alias]]): {config_str}")
+            print(f"[CFTL] ERROR: Invalid config (need hostname_alias:service_alias:port[:aud_alias[:email_alias[:profile]]]): {config_str}")
             continue
         
         hostname_alias = parts[0].strip()
@@ -98,6 +177,14 @@ def parse_services_env() -> List[ServiceConfig]:
         
         port = parts[2].strip()
         
+        if not port.isdigit() or not 0 < int(port) < 65536:
+            print(f"[CFTL] ERROR: Invalid port '{port}': {config_str}")
+            continue
+        
+        if not service or any(c in service for c in ' \t;{}'):
+            print(f"[CFTL] ERROR: Invalid service host '{service}': {config_str}")
+            continue
+        
         aud = None
         if len(parts) > 3 and parts[3].strip():
             aud_alias = parts[3].strip()
@@ -109,32 +196,87 @@ def parse_services_env() -> List[ServiceConfig]:
             email_str = emails.get(email_alias, email_alias)
             email_list = [e.strip().lower() for e in email_str.split(',') if e.strip()]
         
-        config = ServiceConfig(hostname, service, port, aud, email_list)
+        profile = DEFAULT_PROFILE
+        if len(parts) > 5 and parts[5].strip():
+            profile = parts[5].strip().lower()
+            if profile not in PROXY_PROFILES:
+                print(f"[CFTL] ERROR: Unknown profile '{profile}' (available: {', '.join(PROXY_PROFILES)}): {config_str}")
+                continue
+        
+        config = ServiceConfig(hostname, service, port, aud, email_list, profile)
+        
+        if config.name in seen_names:
+            print(f"[CFTL] ERROR: Duplicate hostname '{config.hostname}' (already configured): {config_str}")
+            continue
+        
+        seen_names.add(config.name)
         services.append(config)
     
     return services
 
-def generate_nginx_config(service: ServiceConfig, listen_port: int, auth_port: int) -> str:
-    """Generate nginx configuration"""
-    if service.needs_auth():
-        template_file = '/app/service-template.conf'
+@functools.lru_cache(maxsize=None)
+def load_template(path: str) -> Tuple[str, ...]:
+    """Load a template once, pre-split into literal text and placeholder names"""
+    with open(path, 'r') as f:
+        return tuple(PLACEHOLDER_RE.split(f.read()))
+
+def render_template(template: Tuple[str, ...], values: Dict[str, str]) -> str:
+    """Fill a pre-split template in a single pass"""
+    return ''.join(
+        values.get(part, '{%s}' % part) if i % 2 else part
+        for i, part in enumerate(template)
+    )
+
+@functools.lru_cache(maxsize=None)
+def render_proxy_settings(profile: str) -> str:
+    """Render nginx directives for a proxy performance profile"""
+    settings = PROXY_PROFILES[profile]
+    indent = ' ' * 8
+    
+    lines = [
+        f"proxy_buffering {'on' if settings['buffering'] else 'off'};",
+        f"proxy_connect_timeout {settings['connect_timeout']};",
+        f"proxy_read_timeout {settings['read_timeout']};",
+        f"proxy_send_timeout {settings['send_timeout']};",
+        f"keepalive_timeout {settings['keepalive_timeout']};",
+    ]
+    
+    if settings['gzip']:
+        lines += [
+            "gzip on;",
+            "gzip_proxied any;",
+            "gzip_vary on;",
+            "gzip_min_length 1024;",
+            f"gzip_types {' '.join(settings['gzip_types'])};",
+        ]
     else:
-        template_file = '/app/service-noauth-template.conf'
+        lines.append("gzip off;")
     
-    with open(template_file, 'r') as f:
-        template = f.read()
+    return '\n'.join(indent + line for line in lines)
+
+def generate_nginx_config(service: ServiceConfig, listen_port: int, auth_port: int,
+                          upstream: Optional[Tuple[str, str]] = None) -> str:
+    """Generate nginx configuration (optionally proxying to another upstream)"""
+    if service.needs_auth():
+        template = load_template(SERVICE_TEMPLATE)
+    else:
+        template = load_template(SERVICE_NOAUTH_TEMPLATE)
     
-    config = template.replace('{LISTEN_PORT}', str(listen_port))
-    config = config.replace('{SERVER_NAME}', service.hostname if service.hostname != '*' else '_')
-    config = config.replace('{SERVICE_HOST}', service.service)
-    config = config.replace('{SERVICE_PORT}', service.port)
-    config = config.replace('{SERVICE_NAME}', service.name)
-    config = config.replace('{AUTH_PORT}', str(auth_port))
+    host, port = upstream or (service.service, service.port)
     
-    return config
+    return render_template(template, {
+        'LISTEN_PORT': str(listen_port),
+        'SERVER_NAME': service.hostname if service.hostname != '*' else '_',
+        'SERVICE_HOST': host,
+        'SERVICE_PORT': str(port),
+        'SERVICE_NAME': service.name,
+        'AUTH_PORT': str(auth_port),
+        'PROFILE_NAME': service.profile,
+        'PROXY_SETTINGS': render_proxy_settings(service.profile),
+    })
 
-def save_auth_config(services: List[ServiceConfig]) -> None:
-    """Save auth config"""
+def build_auth_config(services: List[ServiceConfig]) -> dict:
+    """Build auth config consumed by the auth server"""
     auth_configs = {}
     
     for service in services:
@@ -146,5 +288,210 @@ def save_auth_config(services: List[ServiceConfig]) -> None:
                 'emails': service.emails
             }
     
-    with open('/tmp/auth_config.json', 'w') as f:
-        json.dump(auth_configs, f, indent=2)
+    return auth_configs
+
+def build_outputs(services: List[ServiceConfig], listen_port: int, auth_port: int,
+                  fallback_port: int) -> Dict[str, str]:
+    """Render every generated file except the live service configs, keyed by path"""
+    outputs = {}
+    targets = []
+    
+    fallback = render_template(load_template(FALLBACK_TEMPLATE), {'FALLBACK_PORT': str(fallback_port)})
+    outputs[f'{NGINX_SITES_DIR}/offline_fallback.conf'] = fallback
+    
+    if not services:
+        outputs[f'{NGINX_SITES_DIR}/default.conf'] = DEFAULT_SITE % listen_port
+    
+    for i, service in enumerate(services):
+        filename = f'service_{i}_{service.name}.conf'
+        online = generate_nginx_config(service, listen_port, auth_port)
+        offline = generate_nginx_config(service, listen_port, auth_port,
+                                        upstream=('127.0.0.1', str(fallback_port)))
+        
+        outputs[f'{ONLINE_CONFIGS}/{filename}'] = online
+        outputs[f'{OFFLINE_CONFIGS}/{filename}'] = offline
+        
+        targets.append({
+            'filename': filename,
+            'host': service.service,
+            'port': service.port,
+        })
+    
+    outputs[AUTH_CONFIG_FILE] = json.dumps(build_auth_config(services), indent=2)
+    outputs[TARGETS_FILE] = json.dumps(targets, indent=2)
+    
+    return outputs
+
+def live_filenames(outputs: Dict[str, str]) -> List[str]:
+    """Service config filenames the offline monitor swaps in sites-enabled"""
+    return [target['filename'] for target in json.loads(outputs[TARGETS_FILE])]
+
+def compute_input_hash(services: List[ServiceConfig], ports: Dict[str, int]) -> str:
+    """Hash everything the generated files depend on"""
+    inputs = {
+        'services': [service.to_dict() for service in services],
+        'ports': ports,
+        'profiles': PROXY_PROFILES,
+        'templates': {path: load_template(path) for path in
+                      (SERVICE_TEMPLATE, SERVICE_NOAUTH_TEMPLATE, FALLBACK_TEMPLATE)},
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+def load_manifest() -> dict:
+    """Load the manifest written by the last compilation"""
+    try:
+        with open(MANIFEST_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def file_digest(path: str) -> Optional[str]:
+    """SHA-256 of a file, or None if it cannot be read"""
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+def outputs_intact(manifest: dict) -> bool:
+    """Check generated files on disk still match the manifest"""
+    for path, digest in manifest.get('files', {}).items():
+        if file_digest(path) != digest:
+            return False
+    
+    # Live service configs may hold either variant, depending on backend state
+    for filename in manifest.get('live', []):
+        live = file_digest(f'{NGINX_SITES_DIR}/{filename}')
+        if live is None or live not in (file_digest(f'{ONLINE_CONFIGS}/{filename}'),
+                                        file_digest(f'{OFFLINE_CONFIGS}/{filename}')):
+            return False
+    return True
+
+def stale_files(outputs: Dict[str, str], manifest: dict) -> List[str]:
+    """Previously generated files that are no longer produced"""
+    keep = set(outputs)
+    keep.update(f'{NGINX_SITES_DIR}/{filename}' for filename in live_filenames(outputs))
+    
+    candidates = set(manifest.get('files', {}))
+    candidates.update(f'{NGINX_SITES_DIR}/{filename}' for filename in manifest.get('live', []))
+    candidates.update(glob.glob(f'{NGINX_SITES_DIR}/service_*.conf'))
+    candidates.add(f'{NGINX_SITES_DIR}/default.conf')
+    return sorted(path for path in candidates if path not in keep and os.path.exists(path))
+
+def write_atomic(path: str, content: str) -> None:
+    """Write a file via rename so readers never see partial content"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+def compile_configs(services: List[ServiceConfig], listen_port: int, auth_port: int,
+                    fallback_port: int) -> dict:
+    """Generate all config files, skipping work when inputs are unchanged"""
+    ports = {'listen': listen_port, 'auth': auth_port, 'fallback': fallback_port}
+    input_hash = compute_input_hash(services, ports)
+    manifest = load_manifest()
+    
+    if manifest.get('hash') == input_hash and outputs_intact(manifest):
+        manifest['changed'] = False
+        return manifest
+    
+    outputs = build_outputs(services, listen_port, auth_port, fallback_port)
+    live = live_filenames(outputs)
+    
+    # Services currently switched to the fallback stay there; the monitor restores them
+    offline = set()
+    for filename in live:
+        current = read_file(f'{NGINX_SITES_DIR}/{filename}')
+        if current is not None and current == read_file(f'{OFFLINE_CONFIGS}/{filename}'):
+            offline.add(filename)
+    
+    for path in stale_files(outputs, manifest):
+        os.remove(path)
+    
+    for path, content in outputs.items():
+        write_atomic(path, content)
+    
+    for filename in live:
+        source = OFFLINE_CONFIGS if filename in offline else ONLINE_CONFIGS
+        write_atomic(f'{NGINX_SITES_DIR}/{filename}', outputs[f'{source}/{filename}'])
+    
+    manifest = {
+        'hash': input_hash,
+        'ports': ports,
+        'files': {path: hashlib.sha256(content.encode()).hexdigest()
+                  for path, content in outputs.items()},
+        'live': live,
+        'validated': False,
+    }
+    write_atomic(MANIFEST_FILE, json.dumps(manifest, indent=2))
+    
+    manifest['changed'] = True
+    return manifest
+
+def mark_validated(manifest: dict) -> None:
+    """Record that nginx accepted the current configuration"""
+    manifest = {key: value for key, value in manifest.items() if key != 'changed'}
+    manifest['validated'] = True
+    write_atomic(MANIFEST_FILE, json.dumps(manifest, indent=2))
+
+def read_file(path: str) -> Optional[str]:
+    """Read a file, returning None if it does not exist"""
+    try:
+        with open(path, 'r') as f:
+            return f.read()
+    except OSError:
+        return None
+
+def print_diff(old: str, new: str, old_name: str, new_name: str) -> None:
+    """Print a unified diff between two file contents"""
+    for line in difflib.unified_diff(old.splitlines(), new.splitlines(), old_name, new_name, lineterm=''):
+        print(line)
+
+def main() -> int:
+    """Preview what the current environment would generate (never writes)"""
+    parser = argparse.ArgumentParser(description='Preview CFTL configuration changes')
+    parser.add_argument('--dry-run', action='store_true', help='list new/changed/removed files (default)')
+    parser.add_argument('--diff', action='store_true', help='also show a unified diff of each change')
+    args = parser.parse_args()
+    
+    manifest = load_manifest()
+    ports = manifest.get('ports')
+    if not ports:
+        print(f"[CFTL] ERROR: No generated configuration found ({MANIFEST_FILE}); start CFTL first")
+        return 1
+    
+    services = parse_services_env()
+    
+    input_hash = compute_input_hash(services, ports)
+    unchanged = manifest.get('hash') == input_hash and outputs_intact(manifest)
+    print(f"[CFTL] Input hash {input_hash[:12]} ({'unchanged' if unchanged else 'changed'})")
+    
+    outputs = build_outputs(services, ports['listen'], ports['auth'], ports['fallback'])
+    
+    # Live service configs may be switched to the fallback, so they are
+    # compared through their ONLINE_CONFIGS copies instead
+    for path in stale_files(outputs, manifest):
+        if os.path.dirname(path) != NGINX_SITES_DIR or path in manifest.get('files', {}):
+            print(f"  removed    {path}")
+            if args.diff:
+                print_diff(read_file(path) or '', '', path, '/dev/null')
+    
+    for path, content in outputs.items():
+        current = read_file(path)
+        if current is None:
+            status = 'new'
+        elif current != content:
+            status = 'changed'
+        else:
+            status = 'unchanged'
+        print(f"  {status:<10} {path}")
+        
+        if args.diff and status != 'unchanged':
+            print_diff(current or '', content, path if current is not None else '/dev/null', path)
+    
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,16 +3,13 @@
 Offline/fallback service manager for CFTL
 Monitors services and switches between real backend and fallback
 """
-import os
 import socket
 import subprocess
 import time
-import glob
+import json
 import shutil
-import re
-
-ONLINE_CONFIGS = '/tmp/online_configs'
-OFFLINE_CONFIGS = '/tmp/offline_configs'
+import filecmp
+from config import NGINX_SITES_DIR, ONLINE_CONFIGS, OFFLINE_CONFIGS, TARGETS_FILE
 
 def check_service_online(host: str, port: str) -> bool:
     """Check if a service is reachable"""
@@ -26,48 +23,20 @@ def check_service_online(host: str, port: str) -> bool:
         return False
 
 def prepare_configs():
-    """Prepare online and offline versions of all configs"""
-    fallback_port = os.environ.get('FALLBACK_PORT')
-    services = []
-    
-    # Get all service configs (skip default.conf and fallback.conf)
-    service_configs = glob.glob('/etc/nginx/sites-enabled/service_*.conf')
+    """Load the monitor target list written by the config compiler"""
+    try:
+        with open(TARGETS_FILE, 'r') as f:
+            targets = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"[OFFLINE] ERROR: Cannot read {TARGETS_FILE}: {e}", flush=True)
+        return []
     
-    for config_file in service_configs:
-        filename = os.path.basename(config_file)
-        
-        with open(config_file, 'r') as f:
-            content = f.read()
-        
-        # Extract host and port from first proxy_pass
-        match = re.search(r'proxy_pass\s+http://([^:]+):(\d+)', content)
-        if match:
-            host = match.group(1)
-            port = match.group(2)
-            
-            # Save service info
-            services.append({
-                'filename': filename,
-                'host': host,
-                'port': port,
-                'online': True,
-            })
-            
-            # Save online version (original)
-            online_path = f'{ONLINE_CONFIGS}/{filename}'
-            shutil.copy2(config_file, online_path)
-            
-            # Create and save offline version (with fallback)
-            offline_content = re.sub(
-                r'proxy_pass\s+http://[^:]+:\d+',
-                f'proxy_pass http://127.0.0.1:{fallback_port}',
-                content,
-                count=1  # Only first occurrence
-            )
-            
-            offline_path = f'{OFFLINE_CONFIGS}/{filename}'
-            with open(offline_path, 'w') as f:
-                f.write(offline_content)
+    # Start from whichever variant is live so a kept fallback gets restored
+    services = []
+    for target in targets:
+        filename = target['filename']
+        offline = filecmp.cmp(f'{NGINX_SITES_DIR}/{filename}', f'{OFFLINE_CONFIGS}/{filename}', shallow=False)
+        services.append(dict(target, online=not offline))
     
     return services
 
@@ -83,7 +52,7 @@ def monitor_services(services):
                 port = service['port']
                 previous_state = service['online']
                 
-                nginx_path = f'/etc/nginx/sites-enabled/{filename}'
+                nginx_path = f'{NGINX_SITES_DIR}/{filename}'
                 current_state = check_service_online(host, port)
                 
                 if current_state:
@@ -114,21 +83,7 @@ def monitor_services(services):
 
 def main():
     """Main entry point"""
-    os.makedirs(ONLINE_CONFIGS, exist_ok=True)
-    os.makedirs(OFFLINE_CONFIGS, exist_ok=True)
-    
-    fallback_port = os.environ.get('FALLBACK_PORT')
-    if not fallback_port:
-        print("[OFFLINE] ERROR: FALLBACK_PORT environment variable not set", flush=True)
-        return
-
-    with open('/etc/nginx/sites-enabled/offline_fallback.conf', 'r+', encoding='utf-8') as file:
-        content = file.read().replace('{FALLBACK_PORT}', fallback_port)
-        file.seek(0)
-        file.write(content)
-        file.truncate()
-    
-    # Prepare configs and get service list
+    # Online/offline configs are generated by the config compiler in start.py
     services = prepare_configs()
     
     if not services:
@@ -10,7 +10,7 @@ import subprocess
 import signal
 import time
 import random
-from config import parse_services_env, generate_nginx_config, save_auth_config
+from config import parse_services_env, compile_configs, load_manifest, mark_validated
 
 # Running processes
 processes = []
@@ -31,17 +31,19 @@ def cleanup(signum=None, frame=None):
     
     sys.exit(0)
 
-def find_free_port():
-    """Find a random free port for internal services"""
+def find_free_port(preferred=None):
+    """Find a free port for internal services, reusing the preferred one if possible"""
+    import socket
+    candidates = [preferred] if preferred else []
     while True:
-        port = random.randint(10240, 65295)
-        import socket
+        port = candidates.pop() if candidates else random.randint(10240, 65295)
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
             sock.bind(('127.0.0.1', port))
             sock.close()
             return port
         except:
+            sock.close()
             continue
 
 def main():
@@ -60,10 +62,13 @@ def main():
     
     # Basic configuration
     PORT = int(os.environ.get('PORT', '8080'))
-    AUTH_PORT = find_free_port()
+    
+    # Reuse the previous run's internal ports so unchanged configs need no regeneration
+    previous_ports = load_manifest().get('ports', {})
+    AUTH_PORT = find_free_port(previous_ports.get('auth'))
     os.environ['AUTH_PORT'] = str(AUTH_PORT)
 
-    FALLBACK_PORT = find_free_port()
+    FALLBACK_PORT = find_free_port(previous_ports.get('fallback'))
     while FALLBACK_PORT == AUTH_PORT:
         FALLBACK_PORT = find_free_port()
     os.environ['FALLBACK_PORT'] = str(FALLBACK_PORT)
@@ -76,36 +81,13 @@ def main():
         print("[CFTL] Third layer protection is INACTIVE", flush=True)
         print("[CFTL] Configure CONFIGS environment variable to enable", flush=True)
         
-        # Create default nginx config
-        default_config = """
-server {
-    listen %d;
-    server_name _;
-    
-    location / {
-        return 200 'CF Zero Trust Third Layer\\nStatus: Not Configured\\n\\nSet CONFIGS environment variable to enable third layer protection\\n';
-        add_header Content-Type text/plain;
-    }
-    
-    location /health {
-        return 200 'OK';
-        add_header Content-Type text/plain;
-    }
-}
-""" % PORT
-        
-        with open('/etc/nginx/sites-enabled/default.conf', 'w') as f:
-            f.write(default_config)
+    
+    # Generate nginx, auth and monitor configurations
+    manifest = compile_configs(services, PORT, AUTH_PORT, FALLBACK_PORT)
+    if manifest['changed']:
+        print(f"[CFTL] Configuration generated ({len(manifest['files'])} files)", flush=True)
     else:
-        # Generate nginx configurations
-        for i, service in enumerate(services):
-            config = generate_nginx_config(service, PORT, AUTH_PORT)
-            config_file = f'/etc/nginx/sites-enabled/service_{i}_{service.name}.conf'
-            with open(config_file, 'w') as f:
-                f.write(config)
-        
-        # Save authentication configurations
-        save_auth_config(services)
+        print("[CFTL] Configuration unchanged, reusing generated files", flush=True)
     
     # Start third layer auth server
     auth_process = subprocess.Popen(
@@ -125,12 +107,18 @@ server {
     processes.append(offline_process)
     time.sleep(2)
 
-    # Test nginx configuration
-    result = subprocess.run(['nginx', '-t'], capture_output=True, text=True)
-    if result.returncode != 0:
-        print(f"[CFTL] ERROR: Nginx configuration test failed!", flush=True)
-        print(result.stderr, flush=True)
-        sys.exit(1)
+    # Test nginx configuration (skipped when it already passed for these files)
+    if not manifest.get('validated'):
+        try:
+            result = subprocess.run(['nginx', '-t'], capture_output=True, text=True, timeout=30)
+            error = result.stderr if result.returncode != 0 else None
+        except subprocess.TimeoutExpired:
+            error = 'nginx -t did not finish within 30 seconds'
+        if error is not None:
+            print(f"[CFTL] ERROR: Nginx configuration test failed!", flush=True)
+            print(error, flush=True)
+            sys.exit(1)
+        mark_validated(manifest)
     
     # Start nginx
     nginx_process = subprocess.Popen(
@@ -184,9 +172,9 @@ server {
         print(f"\n[CFTL] Service Details:", flush=True)
         for service in services:
             if service.needs_auth():
-                print(f"  ✓ {service.hostname} -> {service.service}:{service.port} [PROTECTED]", flush=True)
+                print(f"  ✓ {service.hostname} -> {service.service}:{service.port} [PROTECTED] ({service.profile})", flush=True)
             else:
-                print(f"  - {service.hostname} -> {service.service}:{service.port} [NO THIRD LAYER]", flush=True)
+                print(f"  - {service.hostname} -> {service.service}:{service.port} [NO THIRD LAYER] ({service.profile})", flush=True)
     
     if tunnel_token or tunnel_config:
         print(f"\n[CFTL] Cloudflare Tunnel: ACTIVE", flush=True)